@@ -7,12 +7,13 @@ Inkscape extension to generate and modify text using local LLM (Ollama, llamafil
 # Copyright (c) 2026 Rachid, Youven ZEGHLACHE
 
 import inkex
-from inkex import TextElement, Rectangle, Group, Tspan, FlowRoot, FlowPara
-import re
-import urllib.request
+from inkex import TextElement, Rectangle, Group, FlowRoot, FlowPara
 import json
-import ssl
+import re
 import os
+import sys
+import time
+from collections import namedtuple
 from pathlib import Path
 
 
@@ -56,6 +57,387 @@ MODEL_CONFIGS = {
     }
 }
 
+# Tone instructions appended to prompts when creating new text
+CREATE_TONE_INSTRUCTIONS = {
+    'formal': 'Use formal language and professional tone.',
+    'casual': 'Use casual, conversational language.',
+    'professional': 'Use professional business language.',
+    'friendly': 'Use friendly and warm tone.',
+    'enthusiastic': 'Use enthusiastic and energetic language.',
+    'humorous': 'Add humor and wit.',
+    'serious': 'Use serious and straightforward tone.',
+    'poetic': 'Use poetic and artistic language.',
+    'educational': 'Use clear, educational language.',
+    'persuasive': 'Use persuasive and convincing language.',
+    'technical': 'Use precise technical language.',
+    'creative': 'Use creative and imaginative language.'
+}
+
+# Tone instructions appended to prompts when modifying existing text
+CONTEXT_TONE_INSTRUCTIONS = {
+    'formal': '\nUse formal language.',
+    'casual': '\nUse casual language.',
+    'professional': '\nUse professional tone.',
+    'friendly': '\nUse friendly tone.',
+    'enthusiastic': '\nUse enthusiastic tone.',
+    'humorous': '\nAdd humor.',
+    'serious': '\nUse serious tone.',
+    'poetic': '\nUse poetic language.',
+    'educational': '\nUse educational tone.',
+    'persuasive': '\nUse persuasive language.',
+    'technical': '\nUse technical language.',
+    'creative': '\nUse creative language.'
+}
+
+# Prompt templates for modes that work on existing text
+MODE_INSTRUCTIONS = {
+    'modify': "Modify the following text based on this instruction: {prompt}\n\nOriginal text: {text}",
+    'translate': "Translate the following text to {target_language}. Maintain the meaning and tone.\n\nOriginal text: {text}",
+    'summarize': "Summarize the following text to be shorter and more concise while keeping key points.\n\nOriginal text: {text}",
+    'expand': "Expand and elaborate on the following text with more detail and examples.\n\nOriginal text: {text}",
+    'rewrite': "Rewrite and improve the following text for better grammar, clarity, and style.\n\nOriginal text: {text}"
+}
+
+# Seconds an auto-detected local model name stays valid in the on-disk cache
+MODEL_CACHE_TTL = 3600
+
+# Trailing unit of an SVG length and its size in px (user units without a viewBox)
+_UNIT_RE = re.compile(r'\s*([a-zA-Z%]+)\s*$')
+_UNIT_TO_PX = {
+    'px': 1.0,
+    'pt': 96.0 / 72.0,
+    'pc': 16.0,
+    'mm': 96.0 / 25.4,
+    'cm': 96.0 / 2.54,
+    'in': 96.0
+}
+
+# Background workers for network lookups that can overlap with prompt building,
+# created on first use so runs that never auto-detect a model skip the thread pool
+_executor = None
+
+# Shared URL opener, built on first use (urllib and ssl are imported lazily
+# so runs answered from the response cache never load the network stack)
+_opener = None
+
+
+def _get_executor():
+    """Return the shared background worker pool."""
+    global _executor
+    if _executor is None:
+        import concurrent.futures
+        
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    return _executor
+
+
+def _get_opener():
+    """Return the shared URL opener so requests reuse one handler chain."""
+    global _opener
+    if _opener is None:
+        import ssl
+        import urllib.request
+        
+        _opener = urllib.request.build_opener(
+            urllib.request.HTTPSHandler(context=ssl._create_unverified_context())
+        )
+    return _opener
+
+
+def _user_cache_dir():
+    """Per-user directory for cache files, inside the Inkscape profile directory."""
+    profile = os.environ.get('INKSCAPE_PROFILE_DIR')
+    if profile:
+        base = Path(profile)
+    elif os.name == 'nt':
+        base = Path(os.environ.get('APPDATA') or Path.home()) / 'inkscape'
+    elif sys.platform == 'darwin':
+        base = Path.home() / 'Library' / 'Application Support' / 'org.inkscape.Inkscape' / 'config' / 'inkscape'
+    else:
+        base = Path(os.environ.get('XDG_CONFIG_HOME') or Path.home() / '.config') / 'inkscape'
+    return base / 'textgen_ink'
+
+
+def _fresh_cache_value(entry, field, max_age, now=None):
+    """Return entry[field] from a well-formed, unexpired cache entry, else None."""
+    if not isinstance(entry, dict):
+        return None
+    ts = entry.get('ts')
+    value = entry.get(field)
+    if not isinstance(ts, (int, float)) or not isinstance(value, str) or not value:
+        return None
+    if (time.time() if now is None else now) - ts >= max_age:
+        return None
+    return value
+
+
+def _parse_length(value):
+    """Convert an SVG length such as '210mm' to px, or return None if it can't be parsed."""
+    try:
+        match = _UNIT_RE.search(value)
+        if match:
+            return float(value[:match.start()]) * _UNIT_TO_PX[match.group(1).lower()]
+        return float(value)
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def _base_position(mode, doc_width, doc_height):
+    """Anchor point for a position mode, 50 units in from the page edges."""
+    if mode == 'top_left':
+        return (50, 50)
+    elif mode == 'top_center':
+        return (doc_width / 2, 50)
+    elif mode == 'top_right':
+        return (doc_width - 50, 50)
+    elif mode == 'bottom_left':
+        return (50, doc_height - 50)
+    elif mode == 'bottom_center':
+        return (doc_width / 2, doc_height - 50)
+    elif mode == 'bottom_right':
+        return (doc_width - 50, doc_height - 50)
+    elif mode == 'middle_left':
+        return (50, doc_height / 2)
+    elif mode == 'middle_right':
+        return (doc_width - 50, doc_height / 2)
+    # 'center' and unknown modes
+    return (doc_width / 2, doc_height / 2)
+
+
+# Options that drive text layout, captured once per run (see AITextGenerator.text_opts)
+_TextOpts = namedtuple('_TextOpts', [
+    'font_family', 'font_weight', 'font_style', 'text_decoration', 'text_color',
+    'text_align', 'letter_spacing', 'word_spacing', 'max_width', 'wrap_mode',
+    'bg_padding', 'scaled_font_size', 'char_width', 'line_height_px'
+])
+
+
+def _wrap_text(opts, text):
+    """Wrap text to max width; return (lines, width_px, height_px)."""
+    char_width = opts.char_width
+    
+    # Wrapping disabled: only break at existing newlines
+    if opts.max_width <= 0:
+        lines = text.splitlines() or [text]
+        return (lines, max(map(len, lines)) * char_width,
+                len(lines) * opts.line_height_px)
+    
+    max_chars = int(opts.max_width / char_width)
+    
+    # Short single-line text already fits
+    if len(text) <= max_chars and '\n' not in text:
+        return [text], len(text) * char_width, opts.line_height_px
+    
+    if opts.wrap_mode == 'greedy':
+        lines, line_chars = _wrap_greedy(text, max_chars)
+    else:
+        lines, line_chars = _wrap_optimal(text.split(), max_chars)
+    
+    if not lines:
+        lines, line_chars = [text], [len(text)]
+    
+    return (lines, max(line_chars) * char_width,
+            len(lines) * opts.line_height_px)
+
+
+def _wrap_greedy(text, max_chars):
+    """Fill each line with as many words as fit; return (lines, line lengths)."""
+    # Collapse whitespace runs so every break point is a single space
+    text = ' '.join(text.split())
+    n = len(text)
+    lines = []
+    line_chars = []
+
+    i = 0
+    while i < n:
+        # Jump straight to the widest line that could fit, then find the break
+        j = i + max_chars
+        if j >= n:
+            j = n
+        elif text[j] != ' ':
+            space = text.rfind(' ', i, j)
+            if space > i:
+                j = space
+            else:
+                # A single word longer than the line stays whole
+                space = text.find(' ', j)
+                j = n if space == -1 else space
+
+        lines.append(text[i:j])
+        line_chars.append(j - i)
+        i = j + 1
+
+    return lines, line_chars
+
+
+def _wrap_optimal(words, max_chars):
+    """Choose line breaks minimizing the sum of squared slack (Knuth-Plass style).
+
+    Returns (lines, line lengths).
+    """
+    n = len(words)
+
+    # prefix[i] is the length of words[:i], counting one space after each word
+    prefix = [0] * (n + 1)
+    for i, word in enumerate(words):
+        prefix[i + 1] = prefix[i] + len(word) + 1
+
+    # cost[j] is the best total cost of setting words[:j]; prev[j] is where its last line starts
+    cost = [0.0] + [float('inf')] * n
+    prev = [0] * (n + 1)
+
+    for j in range(1, n + 1):
+        for k in range(j - 1, -1, -1):
+            width = prefix[j] - prefix[k] - 1
+            # A line may only overflow when it holds a single word
+            if width > max_chars and k < j - 1:
+                break
+
+            slack = max_chars - width
+            if j == n and slack >= 0:
+                line_cost = 0  # The last line may be as short as it likes
+            else:
+                line_cost = slack * slack
+
+            if cost[k] + line_cost < cost[j]:
+                cost[j] = cost[k] + line_cost
+                prev[j] = k
+
+    # Walk the breaks back from the end
+    lines = []
+    line_chars = []
+    j = n
+    while j > 0:
+        k = prev[j]
+        lines.append(' '.join(words[k:j]))
+        line_chars.append(prefix[j] - prefix[k] - 1)
+        j = k
+    lines.reverse()
+    line_chars.reverse()
+
+    return lines, line_chars
+
+
+def _build_style(opts):
+    """Build text style as a CSS string."""
+    style = [
+        f'font-family:{opts.font_family}',
+        f'font-size:{opts.scaled_font_size}px',
+        f'font-weight:{opts.font_weight}',
+        f'font-style:{opts.font_style}',
+        f'fill:{opts.text_color}',
+        f'text-anchor:{opts.text_align}'
+    ]
+    
+    decoration = opts.text_decoration
+    if decoration and decoration != 'none':
+        valid_decorations = ['underline', 'overline', 'line-through']
+        if decoration in valid_decorations:
+            style.append(f'text-decoration:{decoration}')
+    
+    letter_spacing = opts.letter_spacing
+    if letter_spacing != 0:
+        style.append(f'letter-spacing:{letter_spacing}px')
+    
+    word_spacing = opts.word_spacing
+    if word_spacing != 0:
+        style.append(f'word-spacing:{word_spacing}px')
+    
+    return ';'.join(style)
+
+
+def _estimate_bbox(opts, width, height, position):
+    """Estimate bounding box for wrapped text of a given size at an (x, y) position."""
+    pos_x, pos_y = position
+    align = opts.text_align
+    pad = opts.bg_padding
+    
+    # Calculate x position based on alignment
+    if align == 'middle':
+        x = pos_x - width / 2
+    elif align == 'end':
+        x = pos_x - width
+    else:  # start
+        x = pos_x
+    
+    # Y position starts at the top of the first line
+    y = pos_y - opts.scaled_font_size
+    
+    return {
+        'x': x - pad,
+        'y': y - pad,
+        'width': width + pad * 2,
+        'height': height + pad * 2
+    }
+
+
+def _json_body(data):
+    """Encode a request payload as compact UTF-8 JSON."""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _strip_markdown(text, remove_emphasis=True):
+    """Strip code fences and, optionally, bold/italic markers in a single pass."""
+    # Nothing to strip: skip the character walk entirely
+    if '```' not in text and not (remove_emphasis and ('*' in text or '_' in text)):
+        return text
+    
+    out = []
+    closers = {}
+    n = len(text)
+    i = 0
+    in_fence = False
+    line_start = True
+    
+    while i < n:
+        # Drop the closing marker of an emphasis pair found earlier
+        if i in closers:
+            i += closers.pop(i)
+            line_start = False
+            continue
+        
+        c = text[i]
+        
+        if c == '`' and text.startswith('```', i):
+            if line_start:
+                # Fence line: drop the marker and any info string (e.g. ```python)
+                in_fence = not in_fence
+                end = text.find('\n', i)
+                if end == -1:
+                    # Trailing fence also takes the newline before it
+                    if out and out[-1] == '\n':
+                        out.pop()
+                    break
+                i = end + 1
+            else:
+                i += 3
+                line_start = False
+            continue
+        
+        if remove_emphasis and not in_fence and c in '*_':
+            # Widest marker first so ***bold italic*** loses all three
+            for width in (3, 2, 1):
+                marker = c * width
+                if not text.startswith(marker, i):
+                    continue
+                start = i + width
+                end = text.find(c, start)
+                if end > start and text.startswith(marker, end) and '\n' not in text[start:end]:
+                    closers[end] = width
+                    i = start
+                    break
+            else:
+                out.append(c)
+                i += 1
+            line_start = False
+            continue
+        
+        out.append(c)
+        line_start = c == '\n'
+        i += 1
+    
+    return ''.join(out)
+
 
 class AITextGenerator(inkex.EffectExtension):
     """Extension to generate and modify text using local LLM and cloud providers."""
@@ -64,6 +446,11 @@ class AITextGenerator(inkex.EffectExtension):
         super().__init__()
         self.api_key = None
         self.config = {}
+        self._model_future = None
+        self._style_cache = None
+        self._text_opts = None
+        self._doc_size = None
+        self._last_truncated = False
         self.load_config()
     
     def load_config(self):
@@ -160,6 +547,7 @@ class AITextGenerator(inkex.EffectExtension):
         pars.add_argument("--letter_spacing", type=float, default=0.0, help="Letter spacing")
         pars.add_argument("--word_spacing", type=float, default=0.0, help="Word spacing")
         pars.add_argument("--max_width", type=int, default=600, help="Max text width")
+        pars.add_argument("--wrap_mode", type=str, default="optimal", help="Line breaking mode")
         pars.add_argument("--position_mode", type=str, default="center", help="Position mode")
         pars.add_argument("--x_offset", type=float, default=0.0, help="X position offset")
         pars.add_argument("--y_offset", type=float, default=0.0, help="Y position offset")
@@ -176,6 +564,9 @@ class AITextGenerator(inkex.EffectExtension):
         pars.add_argument("--remove_asterisks", type=inkex.Boolean, default=True, help="Remove markdown asterisks")
         pars.add_argument("--remove_quotes", type=inkex.Boolean, default=True, help="Remove surrounding quotes")
         pars.add_argument("--capitalize_first", type=inkex.Boolean, default=False, help="Capitalize first letter")
+        pars.add_argument("--use_cache", type=inkex.Boolean, default=True, help="Reuse responses for identical requests")
+        pars.add_argument("--cache_ttl_hours", type=float, default=24.0, help="Response cache lifetime in hours")
+        pars.add_argument("--debug", type=inkex.Boolean, default=False, help="Debug output")
     
     def get_api_key(self):
         """Get API key from UI input, config.json, or environment variable."""
@@ -230,6 +621,10 @@ class AITextGenerator(inkex.EffectExtension):
         if self.options.local_model:
             self.options.local_model = self.options.local_model.strip()
         
+        # Debug output can also be enabled from the environment
+        if os.environ.get('TEXTGEN_INK_DEBUG'):
+            self.options.debug = True
+        
         # Get API key for closed-source providers
         if self.options.api_provider in MODEL_CONFIGS:
             self.api_key = self.get_api_key()
@@ -242,14 +637,9 @@ class AITextGenerator(inkex.EffectExtension):
                 self.options.local_model = self.get_default_model()
         
         # Auto-detect model if enabled and no model specified (for local providers)
+        # The lookup runs in the background and is awaited right before the API call
         elif self.options.auto_detect_model and not self.options.local_model:
-            detected_model = self.detect_local_model()
-            if detected_model:
-                self.options.local_model = detected_model
-                inkex.utils.debug(f"Auto-detected model: {detected_model}")
-            else:
-                inkex.errormsg("Could not auto-detect model. Please specify a model name in the API Config tab.")
-                return
+            self._model_future = _get_executor().submit(self.detect_local_model)
         elif not self.options.local_model:
             inkex.errormsg("Please specify a local model name in the API Config tab.")
             return
@@ -257,11 +647,18 @@ class AITextGenerator(inkex.EffectExtension):
         # Handle different operation modes
         if self.options.operation_mode in ['modify', 'translate', 'summarize', 'expand', 'rewrite']:
             # These modes require selected text
-            selected_text = self.get_selected_text()
-            if not selected_text:
+            selected_texts = self.get_all_selected_texts()
+            if not selected_texts:
                 inkex.errormsg(f"Please select a text object for {self.options.operation_mode} mode.\nMake sure you've selected a text element (not a group or other object).")
                 return
             
+            if len(selected_texts) > 1:
+                # Several texts: send them in a single request
+                self.modify_selected_texts(selected_texts)
+                return
+            
+            selected_text = selected_texts[0]
+            
             # Generate modified text
             generated_text = self.generate_text_with_context(selected_text['text'])
             
@@ -280,45 +677,111 @@ class AITextGenerator(inkex.EffectExtension):
                 # Create new text element
                 self.create_text_element(generated_text)
     
+    def wait_for_detected_model(self):
+        """Wait for background model auto-detection; return False if it failed."""
+        if self._model_future is None:
+            return True
+        
+        import concurrent.futures
+        
+        future, self._model_future = self._model_future, None
+        try:
+            detected_model = future.result(timeout=10)
+        except concurrent.futures.TimeoutError:
+            detected_model = None
+        except Exception as e:
+            # Any failure in the worker is reported like a failed detection
+            inkex.utils.debug(f"Could not auto-detect model: {str(e)}")
+            detected_model = None
+        
+        if detected_model:
+            self.options.local_model = detected_model
+            inkex.utils.debug(f"Auto-detected model: {detected_model}")
+            return True
+        
+        inkex.errormsg("Could not auto-detect model. Please specify a model name in the API Config tab.")
+        return False
+    
     def detect_local_model(self):
-        """Auto-detect available model from local provider."""
+        """Auto-detect available model from local provider (cached on disk)."""
+        base_url = self.options.api_url.rstrip('/')
+        cache_key = f"{self.options.api_provider}|{base_url}"
+        
+        cache = self._load_cache(self._model_cache_path())
+        cached_model = _fresh_cache_value(cache.get(cache_key), 'model', MODEL_CACHE_TTL)
+        if cached_model:
+            return cached_model
+        
+        import urllib.request
+        
+        model_name = None
         try:
-            base_url = self.options.api_url.rstrip('/')
-            context = ssl._create_unverified_context()
-            
             if self.options.api_provider == "ollama":
                 # Try Ollama tags endpoint
                 url = f"{base_url}/api/tags"
                 req = urllib.request.Request(url, method='GET')
                 
-                with urllib.request.urlopen(req, timeout=5, context=context) as response:
+                with _get_opener().open(req, timeout=5) as response:
                     result = json.loads(response.read().decode('utf-8'))
                     if 'models' in result and len(result['models']) > 0:
-                        # Return the first available model name
+                        # Use the first available model name
                         model_name = result['models'][0].get('name', '')
-                        return model_name
             
             elif self.options.api_provider == "llamafile":
                 # Try llamafile models endpoint
                 url = f"{base_url}/v1/models"
                 req = urllib.request.Request(url, method='GET')
                 
-                with urllib.request.urlopen(req, timeout=5, context=context) as response:
+                with _get_opener().open(req, timeout=5) as response:
                     result = json.loads(response.read().decode('utf-8'))
                     if 'data' in result and len(result['data']) > 0:
-                        # Return the first available model
-                        return result['data'][0].get('id', 'LLaMA_CPP')
+                        # Use the first available model
+                        model_name = result['data'][0].get('id', 'LLaMA_CPP')
         
         except Exception as e:
             inkex.utils.debug(f"Could not auto-detect model: {str(e)}")
         
+        if model_name:
+            cache[cache_key] = {'model': model_name, 'ts': time.time()}
+            self._save_cache(self._model_cache_path(), cache)
+            return model_name
+        
         return None
     
-    def get_selected_text(self):
-        """Get text from selected text element."""
+    def _model_cache_path(self):
+        """Path of the auto-detected model cache file."""
+        return _user_cache_dir() / 'textgen_ink_models.json'
+    
+    def _response_cache_path(self):
+        """Path of the generated response cache file."""
+        return _user_cache_dir() / 'textgen_ink_cache.json'
+    
+    def _load_cache(self, path):
+        """Load a JSON cache file, falling back to an empty cache on any error."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, ValueError):
+            return {}
+    
+    def _save_cache(self, path, cache):
+        """Save a JSON cache file, ignoring write errors."""
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            if self.options.debug:
+                inkex.utils.debug(f"Could not write cache {path}: {e}")
+    
+    def get_all_selected_texts(self):
+        """Get text from every selected text element (one per selected object)."""
+        selected_texts = []
+        
         # Check if there's any selection
         if not self.svg.selection:
-            return None
+            return selected_texts
         
         # Iterate through selection
         for elem in self.svg.selection:
@@ -326,21 +789,21 @@ class AITextGenerator(inkex.EffectExtension):
             if isinstance(elem, TextElement):
                 text_content = self.extract_text_from_element(elem)
                 if text_content:
-                    return {
+                    selected_texts.append({
                         'element': elem,
                         'text': text_content,
                         'style': elem.style
-                    }
+                    })
             
             # Flow text element
             elif isinstance(elem, FlowRoot):
                 text_content = self.extract_text_from_flowroot(elem)
                 if text_content:
-                    return {
+                    selected_texts.append({
                         'element': elem,
                         'text': text_content,
                         'style': elem.style
-                    }
+                    })
             
             # Check if it's a group containing text
             elif isinstance(elem, Group):
@@ -348,11 +811,11 @@ class AITextGenerator(inkex.EffectExtension):
                 if text_elem:
                     text_content = self.extract_text_from_element(text_elem)
                     if text_content:
-                        return {
+                        selected_texts.append({
                             'element': text_elem,
                             'text': text_content,
                             'style': text_elem.style
-                        }
+                        })
             
             # Try to find text elements in children
             else:
@@ -360,94 +823,60 @@ class AITextGenerator(inkex.EffectExtension):
                     if isinstance(child, TextElement):
                         text_content = self.extract_text_from_element(child)
                         if text_content:
-                            return {
+                            selected_texts.append({
                                 'element': child,
                                 'text': text_content,
                                 'style': child.style
-                            }
+                            })
+                            break
         
-        return None
+        return selected_texts
     
     def find_text_in_group(self, group):
         """Find first text element in a group."""
-        for child in group:
-            if isinstance(child, TextElement):
-                return child
-            elif isinstance(child, FlowRoot):
-                return child
-            elif isinstance(child, Group):
-                result = self.find_text_in_group(child)
-                if result:
-                    return result
+        for child in group.iter(inkex.addNS('text', 'svg'), inkex.addNS('flowRoot', 'svg')):
+            return child
         return None
     
     def extract_text_from_flowroot(self, elem):
         """Extract text from FlowRoot element."""
         text_parts = []
-        for child in elem.iter():
-            if isinstance(child, FlowPara):
-                if child.text:
-                    text_parts.append(child.text)
-                for subchild in child:
-                    if subchild.text:
-                        text_parts.append(subchild.text)
-                    if subchild.tail:
-                        text_parts.append(subchild.tail)
+        for para in elem.iter(inkex.addNS('flowPara', 'svg')):
+            text_parts.extend(t for t in para.itertext() if t and t.strip())
         return ' '.join(text_parts).strip()
     
     def extract_text_from_element(self, elem):
         """Extract all text content from text element including tspans."""
-        text_parts = []
-        
-        if elem.text:
-            text_parts.append(elem.text)
-        
-        for child in elem:
-            if isinstance(child, Tspan):
-                if child.text:
-                    text_parts.append(child.text)
-                if child.tail:
-                    text_parts.append(child.tail)
-            elif hasattr(child, 'text') and child.text:
-                text_parts.append(child.text)
-            
-            if hasattr(child, 'tail') and child.tail:
-                text_parts.append(child.tail)
-        
-        if hasattr(elem, 'tail') and elem.tail:
-            text_parts.append(elem.tail)
-        
-        return ' '.join(text_parts).strip()
+        return ' '.join(t for t in elem.itertext() if t and t.strip()).strip()
     
 
+    def text_opts(self):
+        """Return the layout options for this run, captured once."""
+        if self._text_opts is None:
+            scaled_font_size = self.options.font_size * self.options.text_scale
+            self._text_opts = _TextOpts(
+                font_family=self.options.font_family,
+                font_weight=self.options.font_weight,
+                font_style=self.options.font_style,
+                text_decoration=self.options.text_decoration,
+                text_color=self.options.text_color,
+                text_align=self.options.text_align,
+                letter_spacing=self.options.letter_spacing,
+                word_spacing=self.options.word_spacing,
+                max_width=self.options.max_width,
+                wrap_mode=self.options.wrap_mode,
+                bg_padding=self.options.bg_padding,
+                scaled_font_size=scaled_font_size,
+                char_width=scaled_font_size * 0.6,
+                line_height_px=scaled_font_size * self.options.line_height
+            )
+        return self._text_opts
+    
     def build_text_style(self):
-        """Build text style dictionary."""
-        style = {}
-        
-        # Apply scale to font size
-        scaled_font_size = self.options.font_size * self.options.text_scale
-        
-        style['font-family'] = self.options.font_family
-        style['font-size'] = f'{scaled_font_size}px'
-        style['font-weight'] = self.options.font_weight
-        style['font-style'] = self.options.font_style
-        style['fill'] = self.options.text_color
-        style['text-anchor'] = self.options.text_align
-        
-        if self.options.text_decoration and self.options.text_decoration != 'none':
-            valid_decorations = ['underline', 'overline', 'line-through']
-            if self.options.text_decoration in valid_decorations:
-                style['text-decoration'] = self.options.text_decoration
-        
-        if self.options.letter_spacing != 0:
-            style['letter-spacing'] = f'{self.options.letter_spacing}px'
-        
-        if self.options.word_spacing != 0:
-            style['word-spacing'] = f'{self.options.word_spacing}px'
-        
-        return style
-
-
+        """Build text style as a CSS string (built once per run)."""
+        if self._style_cache is None:
+            self._style_cache = _build_style(self.text_opts())
+        return self._style_cache
 
     def generate_text(self):
         """Generate new text based on prompt."""
@@ -465,21 +894,7 @@ class AITextGenerator(inkex.EffectExtension):
         
         # Add tone instruction
         if self.options.tone != "none":
-            tone_instructions = {
-                'formal': 'Use formal language and professional tone.',
-                'casual': 'Use casual, conversational language.',
-                'professional': 'Use professional business language.',
-                'friendly': 'Use friendly and warm tone.',
-                'enthusiastic': 'Use enthusiastic and energetic language.',
-                'humorous': 'Add humor and wit.',
-                'serious': 'Use serious and straightforward tone.',
-                'poetic': 'Use poetic and artistic language.',
-                'educational': 'Use clear, educational language.',
-                'persuasive': 'Use persuasive and convincing language.',
-                'technical': 'Use precise technical language.',
-                'creative': 'Use creative and imaginative language.'
-            }
-            prompt_parts.append(tone_instructions.get(self.options.tone, ''))
+            prompt_parts.append(CREATE_TONE_INSTRUCTIONS.get(self.options.tone, ''))
         
         prompt_parts.append("\nIMPORTANT: Return ONLY the text content, no explanations or formatting markers.")
         
@@ -487,52 +902,167 @@ class AITextGenerator(inkex.EffectExtension):
     
     def build_context_prompt(self, existing_text):
         """Build prompt for modifying existing text."""
-        mode_instructions = {
-            'modify': f"Modify the following text based on this instruction: {self.options.prompt}\n\nOriginal text: {existing_text}",
-            'translate': f"Translate the following text to {self.options.target_language}. Maintain the meaning and tone.\n\nOriginal text: {existing_text}",
-            'summarize': f"Summarize the following text to be shorter and more concise while keeping key points.\n\nOriginal text: {existing_text}",
-            'expand': f"Expand and elaborate on the following text with more detail and examples.\n\nOriginal text: {existing_text}",
-            'rewrite': f"Rewrite and improve the following text for better grammar, clarity, and style.\n\nOriginal text: {existing_text}"
-        }
+        prompt = self._context_instruction(existing_text)
+        prompt += "\n\nIMPORTANT: Return ONLY the text content, no explanations or formatting markers."
         
-        prompt = mode_instructions.get(self.options.operation_mode, existing_text)
+        return prompt
+    
+    def _context_instruction(self, existing_text):
+        """Build the mode and tone instruction for existing text, without the output rules."""
+        template = MODE_INSTRUCTIONS.get(self.options.operation_mode)
+        if template:
+            prompt = template.format(
+                prompt=self.options.prompt,
+                target_language=self.options.target_language,
+                text=existing_text
+            )
+        else:
+            prompt = existing_text
         
         # Add tone instruction
         if self.options.tone != "none":
-            tone_instructions = {
-                'formal': '\nUse formal language.',
-                'casual': '\nUse casual language.',
-                'professional': '\nUse professional tone.',
-                'friendly': '\nUse friendly tone.',
-                'enthusiastic': '\nUse enthusiastic tone.',
-                'humorous': '\nAdd humor.',
-                'serious': '\nUse serious tone.',
-                'poetic': '\nUse poetic language.',
-                'educational': '\nUse educational tone.',
-                'persuasive': '\nUse persuasive language.',
-                'technical': '\nUse technical language.',
-                'creative': '\nUse creative language.'
-            }
-            prompt += tone_instructions.get(self.options.tone, '')
+            prompt += CONTEXT_TONE_INSTRUCTIONS.get(self.options.tone, '')
         
-        prompt += "\n\nIMPORTANT: Return ONLY the text content, no explanations or formatting markers."
+        return prompt
+    
+    def build_batch_context_prompt(self, texts):
+        """Build a single prompt that modifies several texts as numbered items."""
+        count = len(texts)
+        numbered = '\n'.join(f"<{i}> {' '.join(text.split())}" for i, text in enumerate(texts, 1))
+        
+        prompt = self._context_instruction(numbered)
+        prompt += (
+            f"\n\nThe original text contains {count} separate items numbered <1> to <{count}>. "
+            "Apply the instruction to each item independently."
+            "\n\nIMPORTANT: Output each result on its own line, prefixed with its number in the same <N> form. "
+            "Apart from these <N> numbers, return ONLY the text content, no explanations or formatting markers."
+        )
         
         return prompt
     
-    def call_llm_api(self, prompt):
+    def parse_batch_response(self, response, count):
+        """Split a numbered batch response into its items, or None if incomplete."""
+        items = {}
+        current = None
+        
+        for line in response.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            
+            close = line.find('>')
+            if line.startswith('<') and close > 1 and line[1:close].isdigit():
+                current = int(line[1:close])
+                items[current] = line[close + 1:].strip()
+            elif current is not None:
+                # Continuation of the previous item
+                items[current] += ' ' + line
+        
+        if sorted(items) != list(range(1, count + 1)):
+            return None
+        
+        return [self.clean_text_response(items[i]) for i in range(1, count + 1)]
+    
+    def modify_selected_texts(self, selected_texts):
+        """Modify several selected texts with one LLM request."""
+        count = len(selected_texts)
+        prompt = self.build_batch_context_prompt([t['text'] for t in selected_texts])
+        
+        # The batch reply has to fit every item, so scale the token budget with it
+        max_tokens = self.options.max_tokens
+        self.options.max_tokens = max_tokens * count
+        try:
+            # Cache the reply only once it parses, so a bad one is not replayed
+            response = self.call_llm_api(prompt, store_cache=False)
+            cache_key = self.response_cache_key(prompt) if self.options.use_cache else None
+        finally:
+            self.options.max_tokens = max_tokens
+        if not response:
+            return
+        
+        # A reply cut off at the token limit may still carry every <N> tag
+        results = None if self._last_truncated else self.parse_batch_response(response, count)
+        
+        if results is None:
+            # Fall back to one request per text
+            inkex.utils.debug("Batch response was incomplete, modifying texts one by one.")
+            for selected_text in selected_texts:
+                generated_text = self.generate_text_with_context(selected_text['text'])
+                if generated_text:
+                    self.modify_text_element(selected_text['element'], generated_text)
+            return
+        
+        if cache_key:
+            self.store_cached_response(cache_key, response)
+        
+        for selected_text, generated_text in zip(selected_texts, results):
+            if generated_text:
+                self.modify_text_element(selected_text['element'], generated_text)
+    
+    def call_llm_api(self, prompt, store_cache=True):
         """Call LLM API to generate text (supports Ollama, llamafile, and cloud providers)."""
+        self._last_truncated = False
+        if not self.wait_for_detected_model():
+            return None
+        
+        # Reuse a previous response for identical requests
+        cache_key = self.response_cache_key(prompt) if self.options.use_cache else None
+        if cache_key:
+            cached_text = self.lookup_cached_response(cache_key)
+            if cached_text:
+                return cached_text
         
         if self.options.api_provider == "ollama":
-            return self.call_ollama_api(prompt)
+            text = self.call_ollama_api(prompt)
         elif self.options.api_provider == "llamafile":
-            return self.call_llamafile_api(prompt)
+            text = self.call_llamafile_api(prompt)
         elif self.options.api_provider in MODEL_CONFIGS:
-            return self.call_cloud_api(prompt)
+            text = self.call_cloud_api(prompt)
         elif self.options.api_provider == "custom":
-            return self.call_custom_api(prompt)
+            text = self.call_custom_api(prompt)
         else:
             inkex.errormsg(f"Unknown API provider: {self.options.api_provider}")
             return None
+        
+        if cache_key and text and store_cache:
+            self.store_cached_response(cache_key, text)
+        
+        return text
+    
+    def response_cache_key(self, prompt):
+        """Hash everything that affects the generated (and cleaned) text."""
+        import hashlib
+        
+        key_data = [
+            self.options.api_provider,
+            self.options.api_url.rstrip('/'),
+            self.options.local_model,
+            prompt,
+            self.options.temperature,
+            self.options.max_tokens,
+            self.options.remove_asterisks,
+            self.options.remove_quotes,
+            self.options.capitalize_first
+        ]
+        return hashlib.blake2b(json.dumps(key_data).encode('utf-8'), digest_size=16).hexdigest()
+    
+    def lookup_cached_response(self, cache_key):
+        """Return a cached response if it exists and has not expired."""
+        entry = self._load_cache(self._response_cache_path()).get(cache_key)
+        return _fresh_cache_value(entry, 'text', self.options.cache_ttl_hours * 3600)
+    
+    def store_cached_response(self, cache_key, text):
+        """Store a response, dropping expired and malformed entries."""
+        path = self._response_cache_path()
+        now = time.time()
+        max_age = self.options.cache_ttl_hours * 3600
+        
+        cache = {
+            key: entry for key, entry in self._load_cache(path).items()
+            if _fresh_cache_value(entry, 'text', max_age, now) is not None
+        }
+        cache[cache_key] = {'text': text, 'ts': now}
+        self._save_cache(path, cache)
     
     def call_cloud_api(self, prompt):
         """Call cloud API (OpenAI, Anthropic, Google, etc.)."""
@@ -578,6 +1108,8 @@ class AITextGenerator(inkex.EffectExtension):
     
     def call_anthropic_api(self, prompt, config):
         """Call Anthropic Claude API."""
+        import urllib.request
+        
         url = f"{config['api_url']}/messages"
         
         headers = {
@@ -601,18 +1133,17 @@ class AITextGenerator(inkex.EffectExtension):
         
         req = urllib.request.Request(
             url,
-            data=json.dumps(data).encode('utf-8'),
+            data=_json_body(data),
             headers=headers,
             method='POST'
         )
         
-        context = ssl._create_unverified_context()
-        
         try:
-            with urllib.request.urlopen(req, timeout=120, context=context) as response:
+            with _get_opener().open(req, timeout=120) as response:
                 result = json.loads(response.read().decode('utf-8'))
                 
                 if 'content' in result and len(result['content']) > 0:
+                    self._last_truncated = result.get('stop_reason') == 'max_tokens'
                     text = result['content'][0]['text'].strip()
                     return self.clean_text_response(text)
                 else:
@@ -624,6 +1155,8 @@ class AITextGenerator(inkex.EffectExtension):
     
     def call_google_api(self, prompt, config):
         """Call Google Gemini API."""
+        import urllib.request
+        
         url = f"{config['api_url']}/models/{self.options.local_model}:generateContent?key={self.api_key}"
         
         headers = {
@@ -644,18 +1177,17 @@ class AITextGenerator(inkex.EffectExtension):
         
         req = urllib.request.Request(
             url,
-            data=json.dumps(data).encode('utf-8'),
+            data=_json_body(data),
             headers=headers,
             method='POST'
         )
         
-        context = ssl._create_unverified_context()
-        
         try:
-            with urllib.request.urlopen(req, timeout=120, context=context) as response:
+            with _get_opener().open(req, timeout=120) as response:
                 result = json.loads(response.read().decode('utf-8'))
                 
                 if 'candidates' in result and len(result['candidates']) > 0:
+                    self._last_truncated = result['candidates'][0].get('finishReason') == 'MAX_TOKENS'
                     text = result['candidates'][0]['content']['parts'][0]['text'].strip()
                     return self.clean_text_response(text)
                 else:
@@ -667,6 +1199,8 @@ class AITextGenerator(inkex.EffectExtension):
     
     def call_cohere_api(self, prompt, config):
         """Call Cohere API."""
+        import urllib.request
+        
         url = f"{config['api_url']}/chat"
         
         headers = {
@@ -684,18 +1218,17 @@ class AITextGenerator(inkex.EffectExtension):
         
         req = urllib.request.Request(
             url,
-            data=json.dumps(data).encode('utf-8'),
+            data=_json_body(data),
             headers=headers,
             method='POST'
         )
         
-        context = ssl._create_unverified_context()
-        
         try:
-            with urllib.request.urlopen(req, timeout=120, context=context) as response:
+            with _get_opener().open(req, timeout=120) as response:
                 result = json.loads(response.read().decode('utf-8'))
                 
                 if 'text' in result:
+                    self._last_truncated = result.get('finish_reason') == 'MAX_TOKENS'
                     text = result['text'].strip()
                     return self.clean_text_response(text)
                 else:
@@ -707,6 +1240,8 @@ class AITextGenerator(inkex.EffectExtension):
     
     def call_ollama_api(self, prompt):
         """Call Ollama API."""
+        import urllib.request
+        
         base_url = self.options.api_url.rstrip('/')
         url = f"{base_url}/api/generate"
         
@@ -722,7 +1257,7 @@ class AITextGenerator(inkex.EffectExtension):
         data = {
             'model': self.options.local_model,
             'prompt': full_prompt,
-            'stream': False,  # Disable streaming for reliability
+            'stream': bool(self.options.stream_response),
             'options': {
                 'temperature': self.options.temperature,
                 'num_predict': self.options.max_tokens
@@ -730,7 +1265,7 @@ class AITextGenerator(inkex.EffectExtension):
         }
         
         # Convert to JSON bytes
-        json_data = json.dumps(data).encode('utf-8')
+        json_data = _json_body(data)
         
         # Create request
         req = urllib.request.Request(
@@ -741,25 +1276,30 @@ class AITextGenerator(inkex.EffectExtension):
         )
         
         # Debug output
-        inkex.utils.debug(f"=== Ollama Request ===")
-        inkex.utils.debug(f"URL: {url}")
-        inkex.utils.debug(f"Model: {self.options.local_model}")
-        inkex.utils.debug(f"Temperature: {self.options.temperature}")
-        inkex.utils.debug(f"Max tokens: {self.options.max_tokens}")
-        
-        context = ssl._create_unverified_context()
+        if self.options.debug:
+            inkex.utils.debug("=== Ollama Request ===")
+            inkex.utils.debug(f"URL: {url}")
+            inkex.utils.debug(f"Model: {self.options.local_model}")
+            inkex.utils.debug(f"Temperature: {self.options.temperature}")
+            inkex.utils.debug(f"Max tokens: {self.options.max_tokens}")
         
         try:
-            with urllib.request.urlopen(req, timeout=120, context=context) as response:
+            with _get_opener().open(req, timeout=120) as response:
+                if self.options.stream_response:
+                    return self._handle_ollama_stream(response)
+                
                 response_data = response.read().decode('utf-8')
-                inkex.utils.debug(f"Response (first 300 chars): {response_data[:300]}")
+                if self.options.debug:
+                    inkex.utils.debug(f"Response (first 300 chars): {response_data[:300]}")
                 
                 result = json.loads(response_data)
                 
                 if 'response' in result:
+                    self._last_truncated = result.get('done_reason') == 'length'
                     text = result['response'].strip()
                     text = self.clean_text_response(text)
-                    inkex.utils.debug(f"Cleaned text (first 200 chars): {text[:200]}")
+                    if self.options.debug:
+                        inkex.utils.debug(f"Cleaned text (first 200 chars): {text[:200]}")
                     return text
                 else:
                     inkex.errormsg(f"Unexpected Ollama response format. Keys: {list(result.keys())}")
@@ -780,30 +1320,49 @@ class AITextGenerator(inkex.EffectExtension):
         
         except Exception as e:
             inkex.errormsg(f"Unexpected error calling Ollama:\n{type(e).__name__}: {str(e)}")
-            import traceback
-            inkex.utils.debug(traceback.format_exc())
+            if self.options.debug:
+                import traceback
+                inkex.utils.debug(traceback.format_exc())
             return None
     
-    def _handle_ollama_stream(self, req, context):
-        """Handle streaming response from Ollama."""
-        full_response = ""
-        try:
-            with urllib.request.urlopen(req, timeout=120, context=context) as response:
-                for line in response:
-                    if line:
-                        line_str = line.decode('utf-8').strip()
-                        if line_str:
-                            try:
-                                chunk = json.loads(line_str)
-                                if 'response' in chunk:
-                                    full_response += chunk['response']
-                            except json.JSONDecodeError:
-                                continue
+    def _handle_ollama_stream(self, response):
+        """Read a streamed (newline-delimited JSON) response from Ollama."""
+        parts = []
+        buf = bytearray()
+        done = False
+        
+        while not done:
+            data = response.read(4096)
+            if data:
+                buf += data
+                # Only parse complete lines; a JSON object may span several reads
+                end = buf.rfind(b'\n')
+                if end == -1:
+                    continue
+                lines = buf[:end].split(b'\n')
+                del buf[:end + 1]
+            else:
+                # End of stream: the remainder is the last line
+                lines = [buf]
+                done = True
             
-            return self.clean_text_response(full_response.strip()) if full_response else None
-        except Exception as e:
-            inkex.errormsg(f"Error streaming from Ollama: {str(e)}")
-            return None
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    inkex.errormsg(f"Ollama Error: {chunk['error']}")
+                    return None
+                if 'response' in chunk:
+                    parts.append(chunk['response'])
+                if chunk.get('done'):
+                    # Final chunk: ignore anything the server sends after it
+                    self._last_truncated = chunk.get('done_reason') == 'length'
+                    done = True
+                    break
+        
+        return self.clean_text_response(''.join(parts).strip()) if parts else None
     
     def call_llamafile_api(self, prompt):
         """Call llamafile API."""
@@ -869,20 +1428,21 @@ class AITextGenerator(inkex.EffectExtension):
     
     def _make_api_request(self, url, headers, data, provider="API", timeout=60):
         """Make HTTP request to API."""
+        import urllib.request
+        
         req = urllib.request.Request(
             url,
-            data=json.dumps(data).encode('utf-8'),
+            data=_json_body(data),
             headers=headers,
             method='POST'
         )
         
-        context = ssl._create_unverified_context()
-        
         try:
-            with urllib.request.urlopen(req, timeout=timeout, context=context) as response:
+            with _get_opener().open(req, timeout=timeout) as response:
                 result = json.loads(response.read().decode('utf-8'))
                 
                 if 'choices' in result and len(result['choices']) > 0:
+                    self._last_truncated = result['choices'][0].get('finish_reason') == 'length'
                     text = result['choices'][0]['message']['content'].strip()
                     text = self.clean_text_response(text)
                     return text
@@ -916,21 +1476,12 @@ class AITextGenerator(inkex.EffectExtension):
     
     def clean_text_response(self, text):
         """Clean up text response from API."""
-        # Remove markdown code blocks
-        text = re.sub(r'^```.*?\n', '', text, flags=re.MULTILINE)
-        text = re.sub(r'\n```$', '', text, flags=re.MULTILINE)
-        text = re.sub(r'```', '', text)
-        
-        # Remove markdown asterisks if enabled
-        if self.options.remove_asterisks:
-            text = re.sub(r'\*\*([^\*]+)\*\*', r'\1', text)  # Bold
-            text = re.sub(r'\*([^\*]+)\*', r'\1', text)  # Italic
-            text = re.sub(r'__([^_]+)__', r'\1', text)  # Bold
-            text = re.sub(r'_([^_]+)_', r'\1', text)  # Italic
+        # Remove markdown code fences and, if enabled, bold/italic markers
+        text = _strip_markdown(text, self.options.remove_asterisks)
         
         # Remove quotes if the entire text is quoted and option is enabled
         if self.options.remove_quotes:
-            if (text.startswith('"') and text.endswith('"')) or (text.startswith("'") and text.endswith("'")):
+            if len(text) >= 2 and text[0] == text[-1] and text[0] in ('"', "'"):
                 text = text[1:-1]
         
         # Capitalize first letter if enabled
@@ -942,41 +1493,37 @@ class AITextGenerator(inkex.EffectExtension):
     def create_text_element(self, text):
         """Create new text element with generated text."""
         # Calculate position
-        position = self.calculate_position()
+        pos_x, pos_y = self.calculate_position()
         
         # Create group for text and optional background
         group = Group()
         group.set('id', self.svg.get_unique_id('ai-text'))
         
         # Wrap text if needed
-        wrapped_lines = self.wrap_text(text)
+        wrapped_lines, text_width, text_height = self.wrap_text(text)
         
         # Create text element
         text_elem = TextElement()
-        text_elem.set('x', str(position['x']))
-        text_elem.set('y', str(position['y']))
+        text_elem.attrib.update({'x': str(pos_x), 'y': str(pos_y)})
         
         # Set text style (includes scaling)
-        style_dict = self.build_text_style()
-        text_elem.style = style_dict
+        text_elem.set('style', self.build_text_style())
         
         # Add text lines with scaled line height
-        scaled_font_size = self.options.font_size * self.options.text_scale
-        line_height_px = scaled_font_size * self.options.line_height
-        
-        for i, line in enumerate(wrapped_lines):
-            if i == 0:
-                text_elem.text = line
-            else:
-                tspan = Tspan()
-                tspan.text = line
-                tspan.set('x', str(position['x']))
-                tspan.set('dy', str(line_height_px))
-                text_elem.append(tspan)
+        tspan_tag = inkex.addNS('tspan', 'svg')
+        x = str(pos_x)
+        dy = str(self.text_opts().line_height_px)
+        text_elem.text = wrapped_lines[0]
+        tspans = []
+        for line in wrapped_lines[1:]:
+            tspan = text_elem.makeelement(tspan_tag, x=x, dy=dy)
+            tspan.text = line
+            tspans.append(tspan)
+        text_elem.extend(tspans)
         
         # Add background if requested
         if self.options.use_background:
-            bbox = self.estimate_text_bbox(wrapped_lines, position)
+            bbox = self.estimate_text_bbox(text_width, text_height, (pos_x, pos_y))
             bg_rect = self.create_background_rect(bbox)
             group.append(bg_rect)
         
@@ -994,7 +1541,7 @@ class AITextGenerator(inkex.EffectExtension):
             return
         
         # Wrap new text
-        wrapped_lines = self.wrap_text(new_text)
+        wrapped_lines = self.wrap_text(new_text)[0]
         
         # Get current position
         x = text_elem.get('x', '0')
@@ -1002,8 +1549,7 @@ class AITextGenerator(inkex.EffectExtension):
         
         # Clear existing content
         text_elem.text = ''
-        for child in list(text_elem):
-            text_elem.remove(child)
+        del text_elem[:]
         
         # Determine if we should preserve style
         if self.options.preserve_style:
@@ -1019,37 +1565,30 @@ class AITextGenerator(inkex.EffectExtension):
             line_height_px = scaled_font_size * self.options.line_height
         else:
             # Apply new style (includes scaling)
-            style_dict = self.build_text_style()
-            text_elem.style = style_dict
-            scaled_font_size = self.options.font_size * self.options.text_scale
-            line_height_px = scaled_font_size * self.options.line_height
+            text_elem.set('style', self.build_text_style())
+            line_height_px = self.text_opts().line_height_px
         
         # Add new text lines
-        for i, line in enumerate(wrapped_lines):
-            if i == 0:
-                text_elem.text = line
-            else:
-                tspan = Tspan()
-                tspan.text = line
-                tspan.set('x', x)
-                tspan.set('dy', str(line_height_px))
-                text_elem.append(tspan)
+        tspan_tag = inkex.addNS('tspan', 'svg')
+        dy = str(line_height_px)
+        text_elem.text = wrapped_lines[0]
+        tspans = []
+        for line in wrapped_lines[1:]:
+            tspan = text_elem.makeelement(tspan_tag, x=x, dy=dy)
+            tspan.text = line
+            tspans.append(tspan)
+        text_elem.extend(tspans)
                 
                     
     def modify_flowroot_element(self, flowroot, new_text):
         """Modify FlowRoot element with new text."""
         # Find FlowPara element
-        flow_para = None
-        for child in flowroot:
-            if isinstance(child, FlowPara):
-                flow_para = child
-                break
+        flow_para = flowroot.find(inkex.addNS('flowPara', 'svg'))
         
         if flow_para is not None:
             # Clear existing content
             flow_para.text = new_text
-            for child in list(flow_para):
-                flow_para.remove(child)
+            del flow_para[:]
         else:
             # Create new FlowPara if none exists
             flow_para = FlowPara()
@@ -1057,125 +1596,72 @@ class AITextGenerator(inkex.EffectExtension):
             flowroot.append(flow_para)
     
     def wrap_text(self, text):
-        """Wrap text to max width."""
-        # Apply scale to calculations
-        scaled_font_size = self.options.font_size * self.options.text_scale
-        char_width = scaled_font_size * 0.6
-        max_chars = int(self.options.max_width / char_width)
-        
-        words = text.split()
-        lines = []
-        current_line = []
-        current_length = 0
-        
-        for word in words:
-            word_length = len(word)
-            
-            if current_length + word_length + len(current_line) <= max_chars:
-                current_line.append(word)
-                current_length += word_length
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
-                current_length = word_length
-        
-        if current_line:
-            lines.append(' '.join(current_line))
-        
-        return lines if lines else [text]
+        """Wrap text to max width; return (lines, width_px, height_px)."""
+        return _wrap_text(self.text_opts(), text)
     
-    def calculate_position(self):
-        """Calculate position based on position mode."""
-        # Get document dimensions
+    def document_size(self):
+        """Get document width and height in user units, read once per run."""
+        if self._doc_size is None:
+            self._doc_size = self._read_document_size()
+        return self._doc_size
+    
+    def _read_document_size(self):
+        """Read document width and height in user units from the SVG root."""
+        # Positions are in user units, which the viewBox defines when present
         try:
-            doc_width = float(self.svg.get('width').replace('px', '').replace('mm', '').replace('pt', ''))
-        except:
-            doc_width = self.svg.viewport_width or 800
+            viewbox = [float(v) for v in self.svg.get('viewBox', '').replace(',', ' ').split()]
+        except ValueError:
+            viewbox = []
+        if len(viewbox) == 4 and viewbox[2] > 0 and viewbox[3] > 0:
+            return viewbox[2], viewbox[3]
+        
+        # Without a viewBox one user unit is one px
+        doc_width = _parse_length(self.svg.get('width')) or self.svg.viewport_width or 800
+        doc_height = _parse_length(self.svg.get('height')) or self.svg.viewport_height or 600
+        return doc_width, doc_height
+    
+    def calculate_position(self):
+        """Calculate (x, y) position based on position mode."""
+        options = self.options
+        mode = options.position_mode
+        x_offset = options.x_offset
+        y_offset = options.y_offset
         
-        try:
-            doc_height = float(self.svg.get('height').replace('px', '').replace('mm', '').replace('pt', ''))
-        except:
-            doc_height = self.svg.viewport_height or 600
-        
-        # Define base positions
-        positions = {
-            'center': {'x': doc_width / 2, 'y': doc_height / 2},
-            'top_left': {'x': 50, 'y': 50},
-            'top_center': {'x': doc_width / 2, 'y': 50},
-            'top_right': {'x': doc_width - 50, 'y': 50},
-            'bottom_left': {'x': 50, 'y': doc_height - 50},
-            'bottom_center': {'x': doc_width / 2, 'y': doc_height - 50},
-            'bottom_right': {'x': doc_width - 50, 'y': doc_height - 50},
-            'middle_left': {'x': 50, 'y': doc_height / 2},
-            'middle_right': {'x': doc_width - 50, 'y': doc_height / 2}
-        }
+        # Get document dimensions
+        doc_width, doc_height = self.document_size()
         
         # Handle cursor/selection position
-        if self.options.position_mode == 'cursor':
-            if self.svg.selection:
-                for elem in self.svg.selection:
-                    bbox = elem.bounding_box()
-                    if bbox:
-                        return {
-                            'x': bbox.center_x + self.options.x_offset,
-                            'y': bbox.center_y + self.options.y_offset
-                        }
+        if mode == 'cursor':
+            selection = self.svg.selection
+            if selection:
+                # Center on the union of everything selected
+                bbox = selection.bounding_box()
+                if bbox:
+                    return (bbox.center_x + x_offset, bbox.center_y + y_offset)
             # Fallback to center if no selection
-            return {
-                'x': doc_width / 2 + self.options.x_offset,
-                'y': doc_height / 2 + self.options.y_offset
-            }
+            return (doc_width / 2 + x_offset, doc_height / 2 + y_offset)
         
         # Get base position
-        base_pos = positions.get(self.options.position_mode, positions['center'])
+        x, y = _base_position(mode, doc_width, doc_height)
         
         # Apply offsets
-        return {
-            'x': base_pos['x'] + self.options.x_offset,
-            'y': base_pos['y'] + self.options.y_offset
-        }    
-    def estimate_text_bbox(self, lines, position):
-        """Estimate bounding box for text."""
-        # Apply scale to calculations
-        scaled_font_size = self.options.font_size * self.options.text_scale
-        char_width = scaled_font_size * 0.6
-        line_height = scaled_font_size * self.options.line_height
-        
-        max_line_length = max(len(line) for line in lines) if lines else 0
-        width = max_line_length * char_width
-        height = len(lines) * line_height
-        
-        # Calculate x position based on alignment
-        if self.options.text_align == 'middle':
-            x = position['x'] - width / 2
-        elif self.options.text_align == 'end':
-            x = position['x'] - width
-        else:  # start
-            x = position['x']
-        
-        # Y position starts at the top of the first line
-        y = position['y'] - scaled_font_size
-        
-        return {
-            'x': x - self.options.bg_padding,
-            'y': y - self.options.bg_padding,
-            'width': width + self.options.bg_padding * 2,
-            'height': height + self.options.bg_padding * 2
-        }    
+        return (x + x_offset, y + y_offset)
+    
+    def estimate_text_bbox(self, width, height, position):
+        """Estimate bounding box for wrapped text of a given size at an (x, y) position."""
+        return _estimate_bbox(self.text_opts(), width, height, position)
+    
     def create_background_rect(self, bbox):
         """Create background rectangle."""
         rect = Rectangle()
-        rect.set('x', str(bbox['x']))
-        rect.set('y', str(bbox['y']))
-        rect.set('width', str(bbox['width']))
-        rect.set('height', str(bbox['height']))
-        
-        rect.style = {
-            'fill': self.options.bg_color,
-            'fill-opacity': str(self.options.bg_opacity),
-            'stroke': 'none'
-        }
+        rect.attrib.update({
+            'x': f"{bbox['x']:.3f}",
+            'y': f"{bbox['y']:.3f}",
+            'width': f"{bbox['width']:.3f}",
+            'height': f"{bbox['height']:.3f}"
+        })
+        
+        rect.set('style', f'fill:{self.options.bg_color};fill-opacity:{self.options.bg_opacity};stroke:none')
         
         return rect
 